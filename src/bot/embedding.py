@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Optional
+
+from sentence_transformers import SentenceTransformer
+
+
+@lru_cache(maxsize=4)
+def get_embed_model(name: str, backend: str = "torch", file_name: Optional[str] = None) -> SentenceTransformer:
+    """Load a SentenceTransformer once per (name, backend, file) and share it between consumers."""
+    model_kwargs = {"file_name": file_name} if file_name else None
+    return SentenceTransformer(name, backend=backend, model_kwargs=model_kwargs)
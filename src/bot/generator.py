@@ -1,53 +1,222 @@
 from __future__ import annotations
 
+import asyncio
+import copy
+import functools
+import importlib.util
 import logging
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextStreamer
 
 logger = logging.getLogger(__name__)
 
+# Fixed instruction part of the prompt; its KV cache is computed once and reused by every request
+_PREFIX = (
+    "Задача: Ответь на русском кратко (1–2 предложения), ОДНИМ абзацем, БЕЗ списков и нумерации. "
+    "Используй ТОЛЬКО информацию из Контекста. Не добавляй фактов вне контекста. "
+    "Если в контексте нет ответа — напиши: 'В материалах нет точного ответа.'\n\n"
+    "Контекст:\n"
+)
+
+# Constant separators around the per-request question
+_QUESTION_TAG = "\n\nВопрос: "
+_ANSWER_TAG = "\nОтвет:"
+
+# Draft tokens proposed per step when speculative decoding is enabled
+_NUM_ASSISTANT_TOKENS = 5
+
+# Minimum pause between partial-answer callbacks; Telegram throttles frequent message edits
+_STREAM_INTERVAL_SEC = 1.0
+
+
+def _prompt_suffix(ctx: str, question: str) -> str:
+    return f"{ctx}{_QUESTION_TAG}{question}{_ANSWER_TAG}"
+
+
+class _AsyncTextStreamer(TextStreamer):
+    """Hands decoded text from the generator thread to an asyncio.Queue; None marks the end."""
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, queue: "asyncio.Queue[Optional[str]]", **kwargs) -> None:
+        super().__init__(tokenizer, **kwargs)
+        self._loop = loop
+        self._queue = queue
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        if text:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, text)
+        if stream_end:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
 
 class TinyGenerator:
-    def __init__(self, model_name: str = "roneneldan/TinyStories-8M") -> None:
+    def __init__(
+        self,
+        model_name: str = "roneneldan/TinyStories-8M",
+        compile_mode: Optional[str] = None,
+        draft_model_name: Optional[str] = None,
+        load_in_8bit: bool = False,
+    ) -> None:
         self.model_name = model_name
+        # One worker: requests queue up instead of competing for the same weights
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tiny-generator")
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         if self.tokenizer.pad_token_id is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.model = AutoModelForCausalLM.from_pretrained(model_name)
         self.device = (
             "mps" if hasattr(torch.backends, "mps") and torch.backends.mps.is_available() else
             ("cuda" if torch.cuda.is_available() else "cpu")
         )
-        self.model.to(self.device)
+        # Decoding is bound by weight reads, so half-width weights roughly halve the step time
+        self.dtype = torch.bfloat16 if self.device != "cpu" else torch.float32
+        if load_in_8bit and not (self.device == "cuda" and importlib.util.find_spec("bitsandbytes")):
+            logger.warning("8-bit loading needs CUDA and bitsandbytes; loading %s in %s", model_name, self.dtype)
+            load_in_8bit = False
+        if load_in_8bit:
+            from transformers import BitsAndBytesConfig
+
+            # bitsandbytes places the quantized weights itself, so no .to(device) here
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                device_map={"": self.device},
+            )
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=self.dtype)
+            self.model.to(self.device)
         self.model.eval()
-        logger.info("TinyGenerator loaded: %s on %s", model_name, self.device)
+        self.draft_model = self._load_draft(draft_model_name) if draft_model_name else None
+        self._prefix_ids: List[int] = self.tokenizer(_PREFIX).input_ids
+        # SentencePiece tokenizers prepend "▁" to every separately encoded string. Encoding the suffix after the
+        # prefix's final newline and cutting that anchor off reproduces what the whole prompt contains there.
+        self._anchor_ids: List[int] = self._token_ids("\n")
+        self._prefix_cache = None
+        if self._split_prompt_matches():
+            with torch.no_grad():
+                prefix = torch.tensor([self._prefix_ids], device=self.device)
+                self._prefix_cache = self.model(prefix, use_cache=True).past_key_values
+        else:
+            logger.warning("Prefix and suffix tokens of %s do not rejoin into the prompt; prefix cache disabled", model_name)
+        self._eager_forward = self.model.forward
+        self.compiled = False
+        if compile_mode:
+            # Opt-in: the reused prefix cache is a DynamicCache, so prompt length and every decode step give the
+            # compiled forward a new shape (a recompile, and a new CUDA graph under "reduce-overhead"). A StaticCache
+            # would fix the shapes but cannot hold the shared prefix cache, and assisted decoding does not support it.
+            # generate() calls self.model(...) internally, so compile forward rather than wrapping the module.
+            # Prompts are not padded to fixed buckets: the cached prefix must stay at position 0.
+            try:
+                self.model.forward = torch.compile(self.model.forward, mode=compile_mode)
+                self.compiled = True
+            except Exception as e:
+                logger.warning("torch.compile is unavailable for %s: %s", model_name, e)
+        logger.info(
+            "TinyGenerator loaded: %s on %s (%s, compiled: %s)",
+            model_name, self.device, "int8" if load_in_8bit else self.dtype, self.compiled,
+        )
+
+    def _load_draft(self, name: str):
+        # Assisted generation verifies draft tokens by id, so both models must share the vocabulary
+        try:
+            draft_tokenizer = AutoTokenizer.from_pretrained(name)
+            if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                logger.warning("Draft model %s does not share the vocabulary of %s; speculative decoding disabled", name, self.model_name)
+                return None
+            draft = AutoModelForCausalLM.from_pretrained(name, torch_dtype=self.dtype)
+            draft.to(self.device)
+            draft.eval()
+        except Exception as e:
+            logger.warning("Failed to load draft model %s: %s", name, e)
+            return None
+        logger.info("Speculative decoding enabled with draft model %s", name)
+        return draft
+
+    def _token_ids(self, text: str) -> List[int]:
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def _suffix_ids(self, text: str) -> List[int]:
+        ids = self._token_ids("\n" + text)
+        n = len(self._anchor_ids)
+        if ids[:n] == self._anchor_ids:
+            return ids[n:]
+        return self._token_ids(text)
+
+    def _split_prompt_matches(self) -> bool:
+        # The cached prefix is only valid if prefix tokens + suffix tokens decode back to the full prompt
+        suffix = _prompt_suffix("- Пример контекста.", "Сколько стоит обучение?")
+        ids = self._prefix_ids + self._suffix_ids(suffix)
+        decoded = self.tokenizer.decode(ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        return decoded == _PREFIX + suffix
+
+    def _disable_compile(self, reason: Exception) -> None:
+        logger.warning("Compiled generation failed for %s, falling back to eager mode: %s", self.model_name, reason)
+        self.model.forward = self._eager_forward
+        self.compiled = False
 
-    def generate(self, question: str, contexts: List[str], max_new_tokens: int = 120) -> str:
+    def generate(
+        self,
+        question: str,
+        contexts: List[str],
+        max_new_tokens: int = 120,
+        streamer: Optional[TextStreamer] = None,
+    ) -> str:
         # Keep prompt strict and compact for a tiny model
         ctx = "\n\n".join(f"- {c.strip()}" for c in contexts if c and c.strip())
-        prompt = (
-            "Задача: Ответь на русском кратко (1–2 предложения), ОДНИМ абзацем, БЕЗ списков и нумерации. "
-            "Используй ТОЛЬКО информацию из Контекста. Не добавляй фактов вне контекста. "
-            "Если в контексте нет ответа — напиши: 'В материалах нет точного ответа.'\n\n"
-            f"Контекст:\n{ctx}\n\nВопрос: {question}\nОтвет:"
+        suffix = _prompt_suffix(ctx, question)
+        if self._prefix_cache is not None:
+            # Only the context and the question are tokenized per request, as one string.
+            # generate() expects the full sequence and skips the positions already present in past_key_values.
+            ids = self._prefix_ids + self._suffix_ids(suffix)
+        else:
+            ids = self.tokenizer(_PREFIX + suffix).input_ids
+        input_ids = torch.tensor([ids], device=self.device)
+        attention_mask = torch.ones_like(input_ids)
+        gen_kwargs = dict(
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=0.2,
+            top_p=0.9,
+            repetition_penalty=1.1,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
         )
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        with torch.no_grad():
-            out = self.model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                do_sample=True,
-                temperature=0.2,
-                top_p=0.9,
-                repetition_penalty=1.1,
-                eos_token_id=self.tokenizer.eos_token_id,
-                pad_token_id=self.tokenizer.pad_token_id,
+        if self.draft_model is not None:
+            gen_kwargs.update(assistant_model=self.draft_model, num_assistant_tokens=_NUM_ASSISTANT_TOKENS)
+        if streamer is not None:
+            gen_kwargs["streamer"] = streamer
+
+        def _run() -> torch.Tensor:
+            # The cache is extended in place during decoding, so every call works on its own copy
+            cache = copy.deepcopy(self._prefix_cache) if self._prefix_cache is not None else None
+            return self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=cache,
+                **gen_kwargs,
             )
-        text = self.tokenizer.decode(out[0], skip_special_tokens=True)
-        # Extract after 'Ответ:' if present
-        ans = text.split("Ответ:")[-1].strip()
+
+        try:
+            with torch.no_grad():
+                try:
+                    out = _run()
+                except Exception as e:
+                    # Inductor errors surface on the first call, not at torch.compile()
+                    if not self.compiled:
+                        raise
+                    self._disable_compile(e)
+                    if streamer is not None:
+                        # The failed attempt already consumed the prompt; skip it again on the retry
+                        streamer.next_tokens_are_prompt = True
+                    out = _run()
+        except Exception:
+            # Unblock a consumer waiting on the streamer
+            if streamer is not None:
+                streamer.end()
+            raise
+        ans = self.tokenizer.decode(out[0, input_ids.shape[-1]:], skip_special_tokens=True).strip()
         # Post-trim to 2 sentences max and no line breaks
         ans = ans.replace("\n", " ").strip()
         parts = ans.split(".")
@@ -55,4 +224,38 @@ class TinyGenerator:
             ans = ".".join(parts[:2]).strip()
             if not ans.endswith("."):
                 ans += "."
-        return ans or "В материалах нет точного ответа." 
\ No newline at end of file
+        return ans or "В материалах нет точного ответа."
+
+    async def agenerate(
+        self,
+        question: str,
+        contexts: List[str],
+        on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+        max_new_tokens: int = 120,
+    ) -> str:
+        """Run generate() off the event loop, optionally reporting the text decoded so far."""
+        loop = asyncio.get_running_loop()
+        if on_partial is None:
+            return await loop.run_in_executor(self._executor, self.generate, question, contexts, max_new_tokens)
+
+        # Waiting on the queue holds no thread, even while the request is queued behind the generator worker
+        queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+        streamer = _AsyncTextStreamer(self.tokenizer, loop, queue, skip_prompt=True, skip_special_tokens=True)
+        result = loop.run_in_executor(
+            self._executor,
+            functools.partial(self.generate, question, contexts, max_new_tokens, streamer=streamer),
+        )
+        # Also unblock the loop below if generate() fails before streaming starts
+        result.add_done_callback(lambda _: queue.put_nowait(None))
+        partial = ""
+        last_sent = 0.0
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            partial += chunk
+            now = time.monotonic()
+            if partial.strip() and now - last_sent >= _STREAM_INTERVAL_SEC:
+                last_sent = now
+                await on_partial(partial.strip())
+        return await result
@@ -4,10 +4,13 @@ import json
 import logging
 import os
 from dataclasses import dataclass
+from enum import Flag, auto
 from typing import Dict, Optional, List, Tuple
 
+from cachetools import TTLCache
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, BotCommand
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, ContextTypes, filters,
     ConversationHandler, CallbackContext,
@@ -16,14 +19,20 @@ from dotenv import load_dotenv
 
 from src.utils.logging_config import setup_logging
 from src.utils.storage import read_json
+from src.utils.text import compile_keywords, normalize_whitespace
 from src.bot.rag import Retriever, is_relevant, build_answer
-from src.bot.recommender import recommend_electives, score_program, Elective
+from src.bot.recommender import (
+    attach_course_embeddings, build_course_index, recommend_electives, score_programs, Elective,
+)
 from src.bot.generator import TinyGenerator
 
 logger = logging.getLogger(__name__)
 
 SELECT_PROGRAM, ASK_BACKGROUND = range(2)
 
+ANSWER_CACHE_SIZE = 2048
+ANSWER_CACHE_TTL_SEC = 3600
+
 
 @dataclass
 class AppState:
@@ -31,9 +40,12 @@ class AppState:
     programs: Dict[str, Dict]
 
 
-def load_programs(path: str) -> Dict[str, Dict]:
+def load_programs(path: str, encoder=None) -> Dict[str, Dict]:
     arr = read_json(path)
     by_title = {p["title"]: p for p in arr}
+    if encoder is not None:
+        for prog in by_title.values():
+            attach_course_embeddings(prog, encoder)
     return by_title
 
 
@@ -133,7 +145,7 @@ async def recommend_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         return ASK_BACKGROUND
     # If background already present, produce recommendations immediately
     prog = context.bot_data["programs"][prog_name]
-    recs = recommend_electives(bg, prog, top_k=7)
+    recs = recommend_electives(bg, prog, top_k=7, model=context.bot_data["retriever"].model)
     if not recs:
         await update.message.reply_text("Не удалось подобрать подходящие дисциплины. Уточните ваш бэкграунд через /background.")
         return ConversationHandler.END
@@ -153,7 +165,7 @@ async def receive_background(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data["background"] = background
     prog_name = context.user_data.get("program")
     prog = context.bot_data["programs"][prog_name]
-    recs = recommend_electives(background, prog, top_k=7)
+    recs = recommend_electives(background, prog, top_k=7, model=context.bot_data["retriever"].model)
     if not recs:
         await update.message.reply_text("Не удалось подобрать выборные дисциплины. Уточните ваш бэкграунд.")
     else:
@@ -169,16 +181,14 @@ async def receive_background(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def compare_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    programs: Dict[str, Dict] = context.bot_data["programs"]
     bg = (context.user_data.get("background") or "").strip()
     if not bg:
         await update.message.reply_text("Сначала заполните бэкграунд через /background (1–2 предложения).")
         return
-    # Score each program
-    scored: List[Tuple[str, float, List[Elective]]] = []
-    for title, prog in programs.items():
-        agg, recs = score_program(bg, prog, top_k=5)
-        scored.append((title, agg, recs))
+    # Score every program's courses in one pass over the stacked course index
+    scored: List[Tuple[str, float, List[Elective]]] = score_programs(
+        bg, context.bot_data["course_index"], top_k=5, model=context.bot_data["retriever"].model,
+    )
     scored.sort(key=lambda t: t[1], reverse=True)
     best = scored[:2]
     lines: List[str] = []
@@ -190,11 +200,35 @@ async def compare_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     )
 
 
-_COST_WORDS = ("сколько стоит", "стоимост", "цена", "сколько в год", "платн", "руб", "₽")
+_COST_RE = compile_keywords(("сколько стоит", "стоимост", "цена", "сколько в год", "платн", "руб", "₽"))
 
-_PREF_WORDS = (
+_PREF_RE = compile_keywords((
     "лучшие предметы", "самые лучшие", "самые интересные", "что выбрать", "какие предметы лучше",
-)
+))
+
+
+class Intent(Flag):
+    OTHER = 0
+    COST = auto()
+    PREF = auto()
+
+
+def _classify(text: str) -> Intent:
+    # A message may match both lists (e.g. "что выбрать и сколько стоит"), hence a Flag
+    intent = Intent.OTHER
+    if _COST_RE.search(text):
+        intent |= Intent.COST
+    if _PREF_RE.search(text):
+        intent |= Intent.PREF
+    return intent
+
+
+async def _edit_text(message, text: str) -> None:
+    try:
+        await message.edit_text(text)
+    except BadRequest as e:
+        # e.g. "message is not modified" when the final answer equals the last partial
+        logger.debug("Could not edit message: %s", e)
 
 
 async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -208,20 +242,32 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not prog_name:
         await update.message.reply_text("Сначала выберите программу через /start.")
         return
+
+    # Popular questions repeat verbatim across users; reuse the answer instead of retrieval + decoding
+    cache: TTLCache = context.bot_data["answer_cache"]
+    key = (prog_name, normalize_whitespace(text.lower()))
+    cached = cache.get(key)
+    if cached is not None:
+        await update.message.reply_text(cached)
+        return
+    answer = await _answer_question(update, context, text, prog_name)
+    if answer is not None:
+        cache[key] = answer
+
+
+# Answers a free-form question and returns the text that was sent, or None if it should not be cached
+async def _answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, prog_name: str) -> Optional[str]:
+    intent = _classify(text)
     retr: Retriever = context.bot_data["retriever"]
     pairs = retr.search(text, k=8)
     def _prog_score(p):
         d, s = p
-        mt = getattr(d, "meta", {}) or {}
-        return 1 if mt.get("program_title") == prog_name else 0
+        return 1 if d.program_title == prog_name else 0
     pairs.sort(key=lambda p: (_prog_score(p), p[1]), reverse=True)
 
-    if any(w in text.lower() for w in _COST_WORDS):
+    if Intent.COST in intent:
         try:
-            fact_doc = next(
-                (d for d in retr.docs if (d.meta or {}).get("program_title") == prog_name and (d.meta or {}).get("section") == "facts"),
-                None,
-            )
+            fact_doc = retr.fact_doc(prog_name)
             if fact_doc is not None and all(fact_doc is not d for d, _ in pairs):
                 pairs = [(fact_doc, 1.0)] + pairs
         except Exception:
@@ -229,30 +275,40 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     pairs = pairs[:5]
     if not is_relevant(text, pairs):
-        await update.message.reply_text("Я отвечаю только на вопросы по магистерским программам ИТМО (ИИ и AI Product). Уточните вопрос.")
-        return
+        answer = "Я отвечаю только на вопросы по магистерским программам ИТМО (ИИ и AI Product). Уточните вопрос."
+        await update.message.reply_text(answer)
+        # A borderline relevance check should not refuse every later asker for the cache TTL
+        return None
 
     # For vague "best subjects" style queries, prefer deterministic heuristic
-    if any(kw in text.lower() for kw in _PREF_WORDS):
+    if Intent.PREF in intent:
         answer = build_answer(text, pairs)
         await update.message.reply_text(answer)
-        return
+        return answer
 
-    # Try local LLM if configured, with typing indicator
+    # Try local LLM if configured; the status message is updated as the answer is decoded
     generator: Optional[TinyGenerator] = context.bot_data.get("generator")
+    llm_failed = False
     if generator is not None:
         try:
-            await update.message.reply_text("Генерирую ответ…")
+            status = await update.message.reply_text("Генерирую ответ…")
             contexts = [d.text for d, _ in pairs if d and d.text][:5]
-            llm_answer = generator.generate(text, contexts)
+
+            async def _show_partial(partial: str) -> None:
+                await _edit_text(status, partial + " …")
+
+            llm_answer = await generator.agenerate(text, contexts, on_partial=_show_partial)
             if llm_answer and llm_answer.strip():
-                await update.message.reply_text(llm_answer)
-                return
+                await _edit_text(status, llm_answer)
+                return llm_answer
         except Exception as e:
             logger.warning("Local LLM generation failed: %s; falling back to heuristic", e)
+            llm_failed = True
 
     answer = build_answer(text, pairs)
     await update.message.reply_text(answer)
+    # The heuristic fallback after a transient LLM error is not cached, so the next asker retries the LLM
+    return None if llm_failed else answer
 
 
 async def _post_init(app: Application) -> None:
@@ -278,13 +334,16 @@ def build_app(enable_local_llm: bool = False) -> Application:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
 
     retriever = Retriever(index_dir="data/vector_store")
-    programs = load_programs("data/processed/programs.json")
+    programs = load_programs("data/processed/programs.json", encoder=retriever.model)
 
     # Local LLM is enabled only if requested by caller
     generator: Optional[TinyGenerator] = None
     if enable_local_llm:
         try:
-            generator = TinyGenerator(model_name="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+            generator = TinyGenerator(
+                model_name="TinyLlama/TinyLlama-1.1B-Chat-v1.0",
+                draft_model_name="JackFram/llama-68m",
+            )
             logger.info("Local LLM enabled: %s", generator.model_name)
         except Exception as e:
             logger.warning("Failed to initialize local LLM: %s", e)
@@ -293,6 +352,8 @@ def build_app(enable_local_llm: bool = False) -> Application:
 
     app.bot_data["retriever"] = retriever
     app.bot_data["programs"] = programs
+    app.bot_data["course_index"] = build_course_index(programs)
+    app.bot_data["answer_cache"] = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL_SEC)
     app.bot_data["generator"] = generator
 
     conv = ConversationHandler(
@@ -313,7 +374,9 @@ def build_app(enable_local_llm: bool = False) -> Application:
     app.add_handler(CommandHandler("plan", plan_cmd))
     app.add_handler(CommandHandler("background", background_cmd))
     app.add_handler(CommandHandler("compare", compare_cmd))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_router))
+    # Free-form questions may wait on LLM decoding; block=False lets other updates through meanwhile.
+    # Updates stay sequential otherwise: ConversationHandler state must not race.
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_router, block=False))
 
     # Set slash-command hints in clients
     app.post_init = _post_init
@@ -1,53 +1,124 @@
 from __future__ import annotations
 
-import ast
 import logging
-from dataclasses import dataclass
+import mmap
+from collections import defaultdict
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Tuple, Optional, Set
+from typing import Dict, List, Tuple, Optional, Set
 
 import numpy as np
+import orjson
+from cachetools import LRUCache
 from rapidfuzz import fuzz  # type: ignore
-from sentence_transformers import SentenceTransformer
 import faiss  # type: ignore
 
+from src.bot.embedding import get_embed_model
+from src.pipeline.index import EMBEDDINGS_FILE, ENCODER_DIR, QUANTIZED_ONNX_FILE, read_index_model
+from src.utils.text import compile_keywords
+
 logger = logging.getLogger(__name__)
 
+# Candidates fetched from the index per requested hit before exact rescoring
+_RERANK_FACTOR = 2
+
 
 @dataclass
 class Doc:
     id: str
     text: str
     meta: dict
+    # Derived once at load time so per-message helpers skip repeated meta lookups and lower()
+    section: str = field(init=False, repr=False, compare=False)
+    program_title: Optional[str] = field(init=False, repr=False, compare=False)
+    program_url: Optional[str] = field(init=False, repr=False, compare=False)
+    text_lower: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        mt = self.meta or {}
+        self.section = mt.get("section") or ""
+        self.program_title = mt.get("program_title")
+        self.program_url = mt.get("program_url")
+        self.text_lower = (self.text or "").lower()
 
 
 class Retriever:
-    def __init__(self, index_dir: str, model_name: str = "all-MiniLM-L6-v2") -> None:
+    def __init__(self, index_dir: str, model_name: str = "all-MiniLM-L6-v2", query_cache_size: int = 1024) -> None:
         self.index_dir = Path(index_dir)
         self.model_name = model_name
+        # Normalized query -> float32 embedding; repeated questions skip the encoder entirely
+        self._qcache: LRUCache = LRUCache(maxsize=query_cache_size)
         self.docs: List[Doc] = self._load_docs()
-        self.texts = [d.text for d in self.docs]
+        self._by_ps: Dict[Tuple[Optional[str], Optional[str]], List[Doc]] = defaultdict(list)
+        for d in self.docs:
+            self._by_ps[(d.program_title, d.section)].append(d)
         self._init_index()
 
     def _load_docs(self) -> List[Doc]:
-        lines = Path(self.index_dir, "docs.jsonl").read_text(encoding="utf-8").splitlines()
+        path = self.index_dir / "docs.jsonl"
         docs: List[Doc] = []
-        for line in lines:
-            d = ast.literal_eval(line)
-            docs.append(Doc(id=d["id"], text=d["text"], meta=d.get("meta", {})))
+        if path.stat().st_size == 0:
+            return docs
+        # mmap avoids reading the whole file into a str before splitting it
+        with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                if not line.strip():
+                    continue
+                try:
+                    d = orjson.loads(line)
+                except orjson.JSONDecodeError as e:
+                    raise ValueError(f"{path} is not valid JSONL. Rebuild it with src/pipeline/index.py.") from e
+                docs.append(Doc(id=d["id"], text=d["text"], meta=d.get("meta", {})))
         return docs
 
     def _init_index(self) -> None:
         index_path = self.index_dir / "faiss.index"
         if not index_path.exists():
             raise FileNotFoundError(f"FAISS index not found at {index_path}. Build it with src/pipeline/index.py.")
-        self.model = SentenceTransformer(self.model_name)
+        # Queries must be embedded by the same model and backend as the documents
+        self.model_name, backend = read_index_model(self.index_dir, self.model_name)
+        encoder_dir = self.index_dir / ENCODER_DIR
+        if backend == "onnx":
+            if not (encoder_dir / QUANTIZED_ONNX_FILE).exists():
+                raise FileNotFoundError(f"int8 encoder not found at {encoder_dir}. Rebuild the index with src/pipeline/index.py.")
+            self.model = get_embed_model(str(encoder_dir), backend="onnx", file_name=QUANTIZED_ONNX_FILE)
+            logger.info("Using int8 ONNX encoder from %s", encoder_dir)
+        else:
+            self.model = get_embed_model(self.model_name)
         self.index = faiss.read_index(str(index_path))
+        # mmap keeps startup cheap: only the rows touched by rescoring are paged in
+        emb_path = self.index_dir / EMBEDDINGS_FILE
+        self.embs: Optional[np.ndarray] = np.load(emb_path, mmap_mode="r") if emb_path.exists() else None
+
+    def section_docs(self, title: str, section: str) -> List[Doc]:
+        return self._by_ps.get((title, section), [])
+
+    def fact_doc(self, title: str) -> Optional[Doc]:
+        docs = self.section_docs(title, "facts")
+        return docs[0] if docs else None
+
+    def _encode_query(self, query: str) -> np.ndarray:
+        query = query.strip()
+        key = query.lower()
+        qv = self._qcache.get(key)
+        if qv is None:
+            qv = self.model.encode([query], normalize_embeddings=True).astype(np.float32, copy=False)
+            self._qcache[key] = qv
+        return qv
 
     def search(self, query: str, k: int = 5) -> List[Tuple[Doc, float]]:
-        qv = self.model.encode([query], normalize_embeddings=True)
-        sims, idxs = self.index.search(qv.astype(np.float32), k)
-        return [(self.docs[i], float(sims[0, j])) for j, i in enumerate(idxs[0])]
+        qv = self._encode_query(query)
+        if self.embs is None:
+            sims, idxs = self.index.search(qv, k)
+            # FAISS pads missing neighbours with -1 (HNSW can return fewer than k hits)
+            return [(self.docs[i], float(sims[0, j])) for j, i in enumerate(idxs[0]) if i >= 0]
+        # Over-fetch from the approximate index, then rescore against the stored vectors so that
+        # scores (and the is_relevant threshold) do not depend on how the index encodes vectors
+        _sims, idxs = self.index.search(qv, k * _RERANK_FACTOR)
+        cand = idxs[0][idxs[0] >= 0]
+        exact = self.embs[cand].astype(np.float32) @ qv[0]
+        order = np.argsort(-exact, kind="stable")[:k]
+        return [(self.docs[cand[j]], float(exact[j])) for j in order]
 
 
 ALLOWED_KEYWORDS = [
@@ -60,10 +131,21 @@ PROGRAM_ALIASES = [
     "ИИ", "искусственный интеллект", "AI", "AI Product", "проектирование AI-продуктов",
 ]
 
+_KEYWORDS_RE = compile_keywords(ALLOWED_KEYWORDS)
+_TEACHER_RE = compile_keywords([
+    "кто вед", "кто препода", "преподавател", "лектор", "преподы", "кто читает",
+])
+_COST_RE = compile_keywords([
+    "сколько стоит", "стоимост", "цена", "сколько в год", "платн", "руб", "₽",
+])
+_PLAN_HEADING_RE = compile_keywords([
+    "учебный план", "наименование модулей", "блок 1", "обязательные дисциплины", "пул выборных",
+])
+
 
 def is_relevant(question: str, retrieved: List[Tuple[Doc, float]]) -> bool:
     q = question.lower()
-    key_hit = any(kw in q for kw in [k.lower() for k in ALLOWED_KEYWORDS])
+    key_hit = _KEYWORDS_RE.search(q) is not None
     alias_hit = fuzz.partial_ratio(" ".join(PROGRAM_ALIASES).lower(), q) > 70
     retr_hit = any(p[1] > 0.15 for p in retrieved)
     return key_hit or alias_hit or retr_hit
@@ -71,26 +153,20 @@ def is_relevant(question: str, retrieved: List[Tuple[Doc, float]]) -> bool:
 
 def _extract_program_info(docs: List[Doc]) -> Tuple[Optional[str], Optional[str]]:
     for d in docs:
-        mt = d.meta or {}
-        title = mt.get("program_title")
-        url = mt.get("program_url")
-        if title or url:
-            return title, url
+        if d.program_title or d.program_url:
+            return d.program_title, d.program_url
     return None, None
 
 
 def _collect_course_names(docs: List[Doc], limit: int = 5) -> List[str]:
     names: List[str] = []
     for d in docs:
-        section = (d.meta or {}).get("section", "")
-        if section != "course":
+        if d.section != "course":
             continue
         txt = (d.text or "").strip()
         if not txt or len(txt) < 2:
             continue
-        if any(h in txt.lower() for h in [
-            "учебный план", "наименование модулей", "блок 1", "обязательные дисциплины", "пул выборных",
-        ]):
+        if _PLAN_HEADING_RE.search(d.text_lower):
             continue
         if txt not in names:
             names.append(txt)
@@ -100,23 +176,17 @@ def _collect_course_names(docs: List[Doc], limit: int = 5) -> List[str]:
 
 
 def _looks_like_teacher_question(q: str) -> bool:
-    ql = q.lower()
-    return any(k in ql for k in [
-        "кто вед", "кто препода", "преподавател", "лектор", "преподы", "кто читает",
-    ])
+    return _TEACHER_RE.search(q) is not None
 
 
 def _looks_like_cost_question(q: str) -> bool:
-    ql = q.lower()
-    return any(k in ql for k in [
-        "сколько стоит", "стоимост", "цена", "сколько в год", "платн", "руб", "₽",
-    ])
+    return _COST_RE.search(q) is not None
 
 
 def _find_facts(docs: List[Doc]) -> List[str]:
     facts: List[str] = []
     for d in docs:
-        if (d.meta or {}).get("section") == "facts" and d.text:
+        if d.section == "facts" and d.text:
             facts.append(d.text)
     return facts
 
@@ -140,7 +210,7 @@ def build_answer(question: str, retrieved: List[Tuple[Doc, float]]) -> str:
             return fact_line
 
     if _looks_like_teacher_question(question):
-        if not any("препода" in (d.text or "").lower() or "лектор" in (d.text or "").lower() for d in docs):
+        if not any("препода" in d.text_lower or "лектор" in d.text_lower for d in docs):
             base = "В открытых материалах программы нет фиксированного списка преподавателей — он может меняться по семестрам."
             if prog_title and prog_url:
                 return f"{base} Актуальную информацию обычно публикуют на странице программы «{prog_title}»: {prog_url}."
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+import re
 from dataclasses import dataclass
-from typing import List, Dict, Tuple
+from typing import Any, List, Dict, Optional, Tuple
 
-from rapidfuzz import fuzz  # type: ignore
+import numpy as np
+from rapidfuzz import fuzz, process  # type: ignore
 
 
 @dataclass
@@ -12,6 +14,9 @@ class Elective:
     score: float
 
 
+# Share of the fuzzy string score when a dense (embedding) score is also available
+_FUZZY_WEIGHT = 0.5
+
 _HEADING_KEYWORDS = [
     "учебный план",
     "наименование модулей",
@@ -24,14 +29,15 @@ _HEADING_KEYWORDS = [
 ]
 
 
+# Any heading keyword, or "семестр" as a separate word/suffix (e.g., "Пул выборных дисциплин. 1 семестр")
+_HEADING_RE = re.compile("|".join(re.escape(k) for k in _HEADING_KEYWORDS) + r"| семестр|семестр$")
+
+
 def _is_heading(name: str) -> bool:
     nl = (name or "").strip().lower()
     if not nl:
         return True
-    if any(k in nl for k in _HEADING_KEYWORDS):
-        return True
-    if nl.endswith("семестр") or " семестр" in nl:
-        # e.g., "Пул выборных дисциплин. 1 семестр"
+    if _HEADING_RE.search(nl):
         return True
     # Very long section-like lines with lots of spaces but without parentheses/commas may be headings
     if len(nl) > 80 and ("(" not in nl and "," not in nl):
@@ -50,29 +56,100 @@ def _extract_course_names(program: Dict) -> List[str]:
     return names
 
 
-def recommend_electives(background: str, program: Dict, top_k: int = 5) -> List[Elective]:
-    names = _extract_course_names(program)
+def _course_names(program: Dict) -> Tuple[List[str], List[str]]:
+    """Return course names and their lowercased forms, cached on the program dict."""
+    cached = program.get("_course_names")
+    if cached is None:
+        names = _extract_course_names(program)
+        cached = (names, [n.lower() for n in names])
+        program["_course_names"] = cached
+    return cached
+
+
+def attach_course_embeddings(program: Dict, model: Any) -> None:
+    """Encode course names once and keep the normalized matrix on the program dict."""
+    names, _ = _course_names(program)
+    if names:
+        program["_course_emb"] = model.encode(names, normalize_embeddings=True).astype(np.float32)
+
+
+def _score_names(query: str, lowered: List[str], course_emb: Optional[np.ndarray], model: Optional[Any]) -> np.ndarray:
+    # One C-level pass per scorer over all names instead of two calls per course
+    partial = process.cdist([query], lowered, scorer=fuzz.partial_ratio)[0]
+    token_set = process.cdist([query], lowered, scorer=fuzz.token_set_ratio)[0]
+    scores = np.maximum(partial, token_set) / 100.0
+
+    # Embeddings catch paraphrases that share no tokens with the course name
+    if model is not None and course_emb is not None:
+        qv = model.encode([query], normalize_embeddings=True)[0].astype(np.float32)
+        dense = np.clip(course_emb @ qv, 0.0, 1.0)
+        scores = _FUZZY_WEIGHT * scores + (1.0 - _FUZZY_WEIGHT) * dense
+    return scores
+
+
+def _top_electives(names: List[str], scores: np.ndarray, top_k: int) -> List[Elective]:
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return [Elective(name=names[i], score=float(scores[i])) for i in order]
+
+
+def _aggregate(recs: List[Elective]) -> float:
+    # Aggregate: average of top_k scores
+    return sum(e.score for e in recs) / len(recs) if recs else 0.0
+
+
+def recommend_electives(background: str, program: Dict, top_k: int = 5, model: Optional[Any] = None) -> List[Elective]:
+    names, lowered = _course_names(program)
     if not names:
         return []
 
     query = (background or "").lower().strip()
-    scored: List[Elective] = []
-    for name in names:
-        s = max(
-            fuzz.partial_ratio(query, name.lower()),
-            fuzz.token_set_ratio(query, name.lower()),
-        ) / 100.0
-        scored.append(Elective(name=name, score=s))
+    scores = _score_names(query, lowered, program.get("_course_emb"), model)
+    return _top_electives(names, scores, top_k)
 
-    scored.sort(key=lambda e: e.score, reverse=True)
-    return scored[:top_k]
 
-
-def score_program(background: str, program: Dict, top_k: int = 5) -> Tuple[float, List[Elective]]:
+def score_program(background: str, program: Dict, top_k: int = 5, model: Optional[Any] = None) -> Tuple[float, List[Elective]]:
     """Return an aggregate score and top-k electives for a program."""
-    recs = recommend_electives(background, program, top_k=top_k)
-    if not recs:
-        return 0.0, []
-    # Aggregate: average of top_k scores
-    agg = sum(e.score for e in recs) / len(recs)
-    return agg, recs 
\ No newline at end of file
+    recs = recommend_electives(background, program, top_k=top_k, model=model)
+    return _aggregate(recs), recs
+
+
+@dataclass
+class CourseIndex:
+    """Course names of all programs stacked row-wise; slices map a program title to its rows."""
+    names: List[str]
+    lowered: List[str]
+    emb: Optional[np.ndarray]
+    slices: Dict[str, Tuple[int, int]]
+
+
+def build_course_index(programs: Dict[str, Dict]) -> CourseIndex:
+    names: List[str] = []
+    lowered: List[str] = []
+    embs: List[Optional[np.ndarray]] = []
+    slices: Dict[str, Tuple[int, int]] = {}
+    for title, prog in programs.items():
+        prog_names, prog_lowered = _course_names(prog)
+        start = len(names)
+        names.extend(prog_names)
+        lowered.extend(prog_lowered)
+        slices[title] = (start, len(names))
+        if prog_names:
+            embs.append(prog.get("_course_emb"))
+    # Dense scores are used only when every program with courses has embeddings attached
+    emb = np.vstack(embs) if embs and all(e is not None for e in embs) else None
+    return CourseIndex(names=names, lowered=lowered, emb=emb, slices=slices)
+
+
+def score_programs(
+    background: str, index: CourseIndex, top_k: int = 5, model: Optional[Any] = None,
+) -> List[Tuple[str, float, List[Elective]]]:
+    """Like score_program for every program, but all courses are scored in a single pass."""
+    if not index.names:
+        return [(title, 0.0, []) for title in index.slices]
+    query = (background or "").lower().strip()
+    scores = _score_names(query, index.lowered, index.emb, model)
+    results: List[Tuple[str, float, List[Elective]]] = []
+    for title, (start, end) in index.slices.items():
+        recs = _top_electives(index.names[start:end], scores[start:end], top_k)
+        results.append((title, _aggregate(recs), recs))
+    return results
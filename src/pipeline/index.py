@@ -2,44 +2,205 @@ from __future__ import annotations
 
 import argparse
 import logging
+import os
+import shutil
+from itertools import islice
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterable, List, Optional, Sized, Tuple
 
 import numpy as np
 
+from src.bot.embedding import get_embed_model
 from src.utils.logging_config import setup_logging
-from src.utils.storage import read_jsonl, ensure_dir
+from src.utils.storage import count_jsonl, iread_jsonl, ensure_dir
 
+import torch
 from sentence_transformers import SentenceTransformer
 import faiss  # type: ignore
 
 logger = logging.getLogger(__name__)
 
 
+# HNSW graph parameters: neighbours per node, build-time and query-time beam widths
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+
+# Encoder batch size; SentenceTransformer.encode already sorts texts by length, so each batch pads to its own max
+ENCODE_BATCH_SIZE = 64
+
+# Texts pulled from the input per encode() call when building from a stream
+BUILD_CHUNK_TEXTS = 8192
+
+# Database rows scored per matmul block in exact search; keeps the similarity tile cache-sized
+SEARCH_BLOCK_ROWS = 65536
+
+# Optional int8 encoder shipped next to the index; the bot loads it when present
+ENCODER_DIR = "encoder"
+QUANTIZED_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+# Model name and backend the index was built with, one per line; queries must use the same encoder
+MODEL_FILE = "model.txt"
+# Inside ENCODER_DIR: the model the int8 export was made from
+ENCODER_SOURCE_FILE = "source_model.txt"
+
+# Document embeddings stored next to the index (half precision, memory-mapped by the bot)
+EMBEDDINGS_FILE = "embs.fp16.npy"
+
+
+def export_quantized_encoder(model_name: str, out_dir: str | Path) -> Path:
+    """Save the encoder as ONNX with dynamically quantized int8 (AVX512-VNNI) weights."""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    out = Path(out_dir)
+    # Start clean so no file of a previously exported model survives
+    if out.exists():
+        shutil.rmtree(out)
+    ensure_dir(out)
+    model = SentenceTransformer(model_name, backend="onnx")
+    model.save(str(out))
+    export_dynamic_quantized_onnx_model(model, "avx512_vnni", str(out))
+    (out / ENCODER_SOURCE_FILE).write_text(model_name, encoding="utf-8")
+    logger.info("Exported int8 ONNX encoder for %s to %s", model_name, out)
+    return out
+
+
+def _encoder_matches(encoder_dir: Path, model_name: str) -> bool:
+    source = encoder_dir / ENCODER_SOURCE_FILE
+    return (
+        (encoder_dir / QUANTIZED_ONNX_FILE).exists()
+        and source.exists()
+        and source.read_text(encoding="utf-8").strip() == model_name
+    )
+
+
+def read_index_model(index_dir: str | Path, model_name: str) -> Tuple[str, str]:
+    """Return the (model name, backend) an index was built with; the recorded model wins over model_name."""
+    dpath = Path(index_dir)
+    meta = dpath / MODEL_FILE
+    lines = meta.read_text(encoding="utf-8").split() if meta.exists() else []
+    if len(lines) != 2:
+        # Index from before the model was recorded: infer the backend from the shipped encoder
+        backend = "onnx" if (dpath / ENCODER_DIR / QUANTIZED_ONNX_FILE).exists() else "torch"
+        return model_name, backend
+    recorded, backend = lines
+    if recorded != model_name:
+        logger.warning("Index at %s was built with %s, not %s; using %s for queries", dpath, recorded, model_name, recorded)
+    return recorded, backend
+
+
 class FaissIndex:
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2") -> None:
-        self.model = SentenceTransformer(model_name)
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        backend: str = "torch",
+        encoder_dir: Optional[str | Path] = None,
+    ) -> None:
+        self.model_name = model_name
+        self.backend = backend
+        if backend == "onnx":
+            # Export the int8 model once per source model; later builds (and the bot) load the cached file.
+            # Pinned to the AVX512-VNNI export: generic QUInt8 models hit slow ORT kernels.
+            encoder_dir = Path(encoder_dir or Path(".cache", ENCODER_DIR, model_name.replace("/", "__")))
+            if not _encoder_matches(encoder_dir, model_name):
+                export_quantized_encoder(model_name, encoder_dir)
+            self.model = get_embed_model(str(encoder_dir), backend="onnx", file_name=QUANTIZED_ONNX_FILE)
+        else:
+            # Shared per process: repeated FaissIndex instances reuse the loaded weights
+            self.model = get_embed_model(model_name, backend=backend)
         self.index = None
         self.vectors = None
 
-    def build(self, texts: List[str]) -> None:
-        vectors = self.model.encode(texts, show_progress_bar=True, normalize_embeddings=True)
+    def build(self, texts: Iterable[str], total: Optional[int] = None) -> None:
+        # Texts are consumed in chunks, so a generator never has to be materialized.
+        # Chunks are large enough for encode()'s own length sorting to stay effective.
+        # With a known length (len() or total) the chunks are written into one preallocated buffer
+        # instead of concatenated.
+        if isinstance(texts, Sized):
+            total = len(texts)
+        prealloc = total is not None and total > BUILD_CHUNK_TEXTS
+        vectors: Optional[np.ndarray] = None
+        parts: List[np.ndarray] = []
+        offset = 0
+        it = iter(texts)
+        while chunk := list(islice(it, BUILD_CHUNK_TEXTS)):
+            # encode() already returns contiguous float32, so this is not a copy
+            emb = np.asarray(
+                self.model.encode(chunk, batch_size=ENCODE_BATCH_SIZE, show_progress_bar=True, normalize_embeddings=True),
+                dtype=np.float32,
+            )
+            if prealloc:
+                if vectors is None:
+                    vectors = np.empty((total, emb.shape[1]), dtype=np.float32)
+                if offset + len(emb) > total:
+                    raise ValueError(f"build() got more than total={total} texts")
+                vectors[offset:offset + len(emb)] = emb
+                offset += len(emb)
+            else:
+                parts.append(emb)
+        if vectors is None:
+            vectors = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        elif offset != total:
+            raise ValueError(f"build() got {offset} texts, expected total={total}")
         dim = vectors.shape[1]
-        index = faiss.IndexFlatIP(dim)
-        index.add(vectors.astype(np.float32))
+        # Vectors are L2-normalized, so inner product equals cosine similarity.
+        # The graph stores 8-bit codes: a quarter of the bytes streamed per distance; the bot rescores in full precision.
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        # FAISS reads contiguous float32 input in place; self.vectors is the same buffer
+        index.train(vectors)
+        index.add(vectors)
         self.index = index
         self.vectors = vectors
 
     def search(self, queries: List[str], k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
-        qv = self.model.encode(queries, normalize_embeddings=True)
-        sims, idxs = self.index.search(qv.astype(np.float32), k)
-        return sims, idxs
+        qv = self.model.encode(queries, normalize_embeddings=True).astype(np.float32, copy=False)
+        if self.vectors is None:
+            return self.index.search(qv, k)
+        return self._exact_search(qv, k)
+
+    def _exact_search(self, qv: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Brute-force inner product: one threaded sgemm per block of rows, top-k by argpartition,
+        # then a final merge of the per-block winners. Also works on fp16 memory-mapped vectors.
+        n = self.vectors.shape[0]
+        k = min(k, n)
+        best_sims, best_idxs = [], []
+        for start in range(0, n, SEARCH_BLOCK_ROWS):
+            block = np.asarray(self.vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+            sims = qv @ block.T
+            kk = min(k, sims.shape[1])
+            part = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+            best_sims.append(np.take_along_axis(sims, part, axis=1))
+            best_idxs.append(part + start)
+        sims = np.concatenate(best_sims, axis=1)
+        idxs = np.concatenate(best_idxs, axis=1)
+        order = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(sims, order, axis=1), np.take_along_axis(idxs, order, axis=1)
+
+    @classmethod
+    def load(cls, d: str, model_name: str = "all-MiniLM-L6-v2") -> FaissIndex:
+        dpath = Path(d)
+        model_name, backend = read_index_model(dpath, model_name)
+        idx = cls(model_name, backend=backend, encoder_dir=dpath / ENCODER_DIR)
+        idx.index = faiss.read_index(str(dpath / "faiss.index"))
+        # Memory-mapped, as in the bot: pages are served from the OS cache and nothing is re-encoded
+        emb_path = dpath / EMBEDDINGS_FILE
+        idx.vectors = np.load(emb_path, mmap_mode="r") if emb_path.exists() else None
+        return idx
 
     def save(self, d: str) -> None:
         dpath = Path(d)
         ensure_dir(dpath)
         faiss.write_index(self.index, str(dpath / "faiss.index"))
-        (dpath / "model.txt").write_text(self.model._first_module()._get_name(), encoding="utf-8")
+        emb_path = dpath / EMBEDDINGS_FILE
+        if self.vectors is not None:
+            np.save(emb_path, self.vectors.astype(np.float16))
+        else:
+            # e.g. loaded from a dir without embeddings; a stale file there would not match this index
+            logger.warning("No document vectors to save; %s is not written and search will not rescore", emb_path)
+            emb_path.unlink(missing_ok=True)
+        (dpath / MODEL_FILE).write_text(f"{self.model_name}\n{self.backend}\n", encoding="utf-8")
 
 
 def main() -> None:
@@ -48,16 +209,26 @@ def main() -> None:
     parser.add_argument("--in", dest="inp", required=True)
     parser.add_argument("--index_dir", required=True)
     parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument(
+        "--backend", choices=["torch", "onnx"], default="torch",
+        help="onnx: encode with an int8 ONNX export of the model and ship it with the index",
+    )
     args = parser.parse_args()
-
-    docs = read_jsonl(args.inp)
-    texts = [d["text"] for d in docs]
+    # Some torch builds default to far fewer intra-op threads than there are cores
+    torch.set_num_threads(os.cpu_count() or 1)
 
     logger.info("Building FAISS index with model %s", args.model)
-    idx = FaissIndex(model_name=args.model)
-    idx.build(texts)
+    encoder_dir = Path(args.index_dir, ENCODER_DIR)
+    if args.backend != "onnx" and encoder_dir.exists():
+        # A leftover int8 encoder would otherwise be picked up for queries against torch embeddings
+        shutil.rmtree(encoder_dir)
+    # Documents and queries must be embedded by the same (quantized) encoder, so it lives in the index dir
+    idx = FaissIndex(model_name=args.model, backend=args.backend, encoder_dir=encoder_dir)
+    # A cheap counting pass lets build() preallocate the embedding matrix for the streamed corpus
+    idx.build((d["text"] for d in iread_jsonl(args.inp)), total=count_jsonl(args.inp))
     idx.save(args.index_dir)
-    Path(args.index_dir, "docs.jsonl").write_text("\n".join([str(d) for d in docs]), encoding="utf-8")
+    # The input already is the JSONL the bot reads; copy it instead of re-serializing every record
+    shutil.copyfile(args.inp, Path(args.index_dir, "docs.jsonl"))
 
 
 if __name__ == "__main__":
@@ -2,14 +2,22 @@ from __future__ import annotations
 
 import logging
 import random
+import shelve
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from datetime import date
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
 from urllib.parse import urlparse
 from urllib import robotparser
 
 import requests
 
+from src.utils.http import get_session
+from src.utils.storage import ensure_dir
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,28 +34,119 @@ class FetchConfig:
 
 
 class RobotsCache:
-    def __init__(self) -> None:
+    def __init__(self, cache_path: str | Path = ".cache/robots") -> None:
         self._cache: dict[str, robotparser.RobotFileParser] = {}
+        # Guards the in-memory dict and the shelve file; network reads only hold their host's lock
+        self._lock = threading.Lock()
+        self._host_locks: dict[str, threading.Lock] = {}
+        self.cache_path = Path(cache_path)
 
-    def is_allowed(self, url: str, user_agent: str) -> bool:
+    @staticmethod
+    def _disk_key(netloc: str) -> str:
+        # Day granularity: parsed rules are reused for the rest of the day, then re-read
+        return f"{netloc}|{date.today().isoformat()}"
+
+    def _load(self, netloc: str) -> Optional[robotparser.RobotFileParser]:
+        try:
+            with self._lock, shelve.open(str(self.cache_path)) as db:
+                return db.get(self._disk_key(netloc))
+        except Exception:
+            return None
+
+    def _store(self, netloc: str, rp: robotparser.RobotFileParser) -> None:
+        key = self._disk_key(netloc)
+        try:
+            ensure_dir(self.cache_path.parent)
+            with self._lock, shelve.open(str(self.cache_path)) as db:
+                # Drop this host's entries from previous days
+                for old in [k for k in db.keys() if k.startswith(f"{netloc}|") and k != key]:
+                    del db[old]
+                db[key] = rp
+        except Exception as e:
+            logger.warning("Could not persist robots.txt for %s: %s", netloc, e)
+
+    def _read(self, robots_url: str) -> Tuple[robotparser.RobotFileParser, bool]:
+        # Status handling follows RobotFileParser.read(), but over the shared keep-alive session.
+        # Returns the parser and whether the answer is definitive enough to persist.
+        rp = robotparser.RobotFileParser(robots_url)
+        resp = get_session().get(robots_url, timeout=10)
+        code = resp.status_code
+        if code in (401, 403):
+            rp.disallow_all = True
+        elif 400 <= code < 500:
+            rp.allow_all = True
+        elif code >= 500:
+            # Server error: like the stdlib, allow nothing, and retry on the next run
+            logger.warning("robots.txt at %s returned %d; disallowing the host for now", robots_url, code)
+            rp.disallow_all = True
+            return rp, False
+        else:
+            rp.parse(resp.text.splitlines())
+        return rp, True
+
+    def _get(self, url: str) -> robotparser.RobotFileParser:
         parsed = urlparse(url)
-        base = f"{parsed.scheme}://{parsed.netloc}"
-        robots_url = base + "/robots.txt"
-        if robots_url not in self._cache:
-            rp = robotparser.RobotFileParser()
-            try:
-                rp.set_url(robots_url)
-                rp.read()
-            except Exception:
-                # If robots can't be read, be conservative
-                logger.warning("Could not read robots.txt from %s", robots_url)
-                rp = robotparser.RobotFileParser()
-                rp.parse("")
-            self._cache[robots_url] = rp
-        return self._cache[robots_url].can_fetch(user_agent, url)
+        robots_url = f"{parsed.scheme}://{parsed.netloc}/robots.txt"
+        with self._lock:
+            rp = self._cache.get(robots_url)
+            if rp is not None:
+                return rp
+            host_lock = self._host_locks.setdefault(robots_url, threading.Lock())
+        # Each robots.txt is read only once, while different hosts are read concurrently
+        with host_lock:
+            with self._lock:
+                rp = self._cache.get(robots_url)
+            if rp is not None:
+                return rp
+            rp = self._load(parsed.netloc)
+            if rp is None:
+                try:
+                    rp, persist = self._read(robots_url)
+                    if persist:
+                        self._store(parsed.netloc, rp)
+                except Exception:
+                    # If robots can't be read, be conservative
+                    logger.warning("Could not read robots.txt from %s", robots_url)
+                    rp = robotparser.RobotFileParser()
+                    rp.parse("")
+            with self._lock:
+                self._cache[robots_url] = rp
+            return rp
+
+    def prewarm(self, urls: Iterable[str], max_workers: int = 8) -> None:
+        """Read robots.txt for every distinct host up front, in parallel."""
+        by_host: dict[str, str] = {}
+        for url in urls:
+            parsed = urlparse(url)
+            by_host.setdefault(f"{parsed.scheme}://{parsed.netloc}", url)
+        if not by_host:
+            return
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(by_host))) as ex:
+            list(ex.map(self._get, by_host.values()))
+
+    def is_allowed(self, url: str, user_agent: str) -> bool:
+        return self._get(url).can_fetch(user_agent, url)
+
+
+class HostThrottle:
+    """Polite delay between requests to the same host; different hosts do not wait for each other."""
+
+    def __init__(self) -> None:
+        self._next_at: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host: str, min_delay_sec: float, max_delay_sec: float) -> None:
+        # Reserve the next slot for this host under the lock, then sleep outside it
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_at.get(host, now))
+            self._next_at[host] = start + random.uniform(min_delay_sec, max_delay_sec)
+        if start > now:
+            time.sleep(start - now)
 
 
 robots_cache = RobotsCache()
+host_throttle = HostThrottle()
 
 
 def fetch_html(url: str, cfg: Optional[FetchConfig] = None) -> str:
@@ -57,11 +156,11 @@ def fetch_html(url: str, cfg: Optional[FetchConfig] = None) -> str:
 
     headers = {"User-Agent": cfg.user_agent, "Accept-Language": "ru,en;q=0.8"}
 
+    host = urlparse(url).netloc
     for attempt in range(1, cfg.max_retries + 1):
-        delay = random.uniform(cfg.min_delay_sec, cfg.max_delay_sec)
-        time.sleep(delay)
+        host_throttle.wait(host, cfg.min_delay_sec, cfg.max_delay_sec)
         try:
-            resp = requests.get(url, headers=headers, timeout=cfg.timeout_sec)
+            resp = get_session().get(url, headers=headers, timeout=cfg.timeout_sec)
             if resp.status_code >= 500:
                 raise requests.RequestException(f"Server error {resp.status_code}")
             resp.raise_for_status()
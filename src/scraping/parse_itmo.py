@@ -1,32 +1,35 @@
 from __future__ import annotations
 
 import argparse
-import json
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
 
-from bs4 import BeautifulSoup
+import orjson
+from selectolax.parser import HTMLParser, Node
 
-from src.scraping.fetch import fetch_html
+from src.scraping.fetch import fetch_html, robots_cache
+from src.utils.http import enable_http_cache
 from src.utils.logging_config import setup_logging
-from src.utils.text import normalize_whitespace
+from src.utils.text import compile_keywords, normalize_whitespace
 from src.utils.storage import write_json
 from src.utils.pdf import extract_text_from_pdf
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+# slots: curricula create thousands of these, and nothing sets extra attributes on them
+@dataclass(slots=True)
 class Course:
     name: str
     semester: Optional[str] = None
     type: Optional[str] = None  # core | elective | module | other
 
 
-@dataclass
+@dataclass(slots=True)
 class Program:
     url: str
     title: str
@@ -41,14 +44,97 @@ class Program:
     contacts: Dict[str, str]
 
 
-def _extract_text(el) -> str:
+# Fallback patterns for facts missing from apiProgram, matched against the page text
+_TUITION_PATTERNS = (
+    re.compile(r"(?:стоимост[ьи]|цена)[^\n\r\.:]{0,60}?([\d\s]{3,}(?:[.,]\d{3})?\s*(?:₽|руб\.?|рублей|RUB))", re.IGNORECASE),
+    re.compile(r"([\d\s]{3,}(?:[.,]\d{3})?\s*(?:₽|руб\.?|рублей|RUB))\s*(?:в год|за год|/год)", re.IGNORECASE),
+)
+_DURATION_PATTERNS = (
+    re.compile(r"(?:срок\s*обучения|продолжительность)[^\n\r\.:]{0,40}?(\d+(?:[.,]\d+)?\s*г(?:ода|одов|\.)?)", re.IGNORECASE),
+    re.compile(r"(\d+(?:[.,]\d+)?\s*г(?:ода|одов|\.)?)\s*(?:обучения)?", re.IGNORECASE),
+)
+_LANG_PATTERNS = (
+    re.compile(r"(?:язык\s*обучения|language)[^\n\r\.:]{0,40}?(русский|английский|русский и английский|bilingual|english|russian)", re.IGNORECASE),
+)
+_FAC_PATTERNS = (
+    re.compile(r"(?:факультет|меганаправление|школа)[^\n\r\.:]{0,60}?([A-Za-zА-Яа-я \-«»\"]{6,60})", re.IGNORECASE),
+)
+
+# Curriculum section headings and elective markers in the HTML fallback
+_HEADING_KEYWORDS = ("Учебн", "План", "Дисциплин", "Модул", "Выбор", "Курс")
+_HEADING_RE = compile_keywords(_HEADING_KEYWORDS)
+_ELECTIVE_RE = re.compile(r"выбор", re.IGNORECASE)
+
+# Tags whose contents are not page text
+_NON_TEXT_TAGS = ["script", "style", "template"]
+
+# Page headers/footers in the academic plan PDF that are not course names
+_PDF_SKIP_RE = compile_keywords(["страница", "page", "итмо", "университет", "семестр:"])
+
+# Contact links
+_EMAIL_RE = re.compile(r"mailto:", re.IGNORECASE)
+_TEL_RE = re.compile(r"tel:", re.IGNORECASE)
+
+
+def _extract_text(el: Optional[Node]) -> str:
     if el is None:
         return ""
-    text = el.get_text(" ", strip=True)
+    text = el.text(separator=" ", strip=True)
     return normalize_whitespace(text)
 
 
-def _first_match(patterns: List[re.Pattern[str]], text: str) -> Optional[str]:
+# selectolax's css("a, b") yields matches grouped per selector, and Node.traverse() also walks the
+# following siblings, so the element lookups below are small helpers that keep document order.
+
+def _iter_tags(tree: HTMLParser, tags: Iterable[str]) -> Iterator[Node]:
+    wanted = set(tags)
+    return (n for n in tree.root.traverse() if n.tag in wanted)
+
+
+def _find_all(el: Node, tags: Iterable[str]) -> List[Node]:
+    # css("*") includes el itself; skip it like find_all does
+    wanted = set(tags)
+    return [n for n in el.css("*") if n.tag in wanted and n.mem_id != el.mem_id]
+
+
+def _find_next(tree: HTMLParser, el: Node, tags: Iterable[str]) -> Optional[Node]:
+    wanted = set(tags)
+    seen = False
+    for n in tree.root.traverse():
+        if seen and n.tag in wanted:
+            return n
+        seen = seen or n.mem_id == el.mem_id
+    return None
+
+
+def _find_parent(el: Node, tags: Iterable[str]) -> Optional[Node]:
+    wanted = set(tags)
+    parent = el.parent
+    while parent is not None and parent.tag != "-undef":
+        if parent.tag in wanted:
+            return parent
+        parent = parent.parent
+    return None
+
+
+def _node_string(el: Node) -> Optional[str]:
+    # Text of the only child, followed down single-child chains (mixed-content headings do not count)
+    child = el.child
+    if child is None or child.next is not None:
+        return None
+    if child.tag == "-text":
+        return child.text_content
+    return _node_string(child)
+
+
+def _find_link(tree: HTMLParser, href_re: re.Pattern[str]) -> Optional[Node]:
+    for a in tree.css("a[href]"):
+        if href_re.search(a.attributes.get("href") or ""):
+            return a
+    return None
+
+
+def _first_match(patterns: Sequence[re.Pattern[str]], text: str) -> Optional[str]:
     for pat in patterns:
         m = pat.search(text)
         if m:
@@ -61,21 +147,22 @@ def _first_match(patterns: List[re.Pattern[str]], text: str) -> Optional[str]:
 
 def parse_program(url: str) -> Program:
     html = fetch_html(url)
-    soup = BeautifulSoup(html, "lxml")
+    tree = HTMLParser(html)
 
     # Prefer robust data from Next.js __NEXT_DATA__ when present
-    next_data = soup.find("script", id="__NEXT_DATA__")
+    next_data = tree.css_first("script#__NEXT_DATA__")
     api = None
-    if next_data:
+    if next_data is not None:
         try:
-            import json
-            nd = json.loads(next_data.text)
+            nd = orjson.loads(next_data.text())
             api = (nd.get("props", {}) or {}).get("pageProps", {}).get("apiProgram")
         except Exception:
             api = None
+    # Remaining text extraction should not see script/style contents
+    tree.strip_tags(_NON_TEXT_TAGS)
 
     # Title
-    title_tag = soup.find(["h1", "h2"])
+    title_tag = next(_iter_tags(tree, ["h1", "h2"]), None)
     title = _extract_text(title_tag) or (api.get("title") if api else None) or "Программа магистратуры"
 
     # Heuristics for fields
@@ -86,8 +173,6 @@ def parse_program(url: str) -> Program:
     faculty = None
     tuition = None
 
-    page_text = _extract_text(soup)
-
     if api:
         code = api.get("direction_code") or code
         degree = api.get("degree") or degree
@@ -107,15 +192,16 @@ def parse_program(url: str) -> Program:
 
     # Description: take the first prominent text block under title
     desc = ""
-    if title_tag:
+    if title_tag is not None:
         # find next sizable paragraph or section
-        next_section = title_tag.find_next(["p", "div", "section"])
-        if next_section:
+        next_section = _find_next(tree, title_tag, ["p", "div", "section"])
+        if next_section is not None:
             desc = _extract_text(next_section)[:2000]
     if not desc:
         # fallback to meta description
-        meta_desc = soup.find("meta", attrs={"name": "description"})
-        desc = meta_desc["content"][:2000] if meta_desc and meta_desc.get("content") else ""
+        meta_desc = tree.css_first('meta[name="description"]')
+        content = meta_desc.attributes.get("content") if meta_desc is not None else None
+        desc = content[:2000] if content else ""
 
     # Curriculum extraction
     curriculum: List[Course] = []
@@ -143,30 +229,31 @@ def parse_program(url: str) -> Program:
             # Heuristic: lines that look like course names (exclude headers, page numbers)
             for line in pdf_text.splitlines():
                 t = line.strip()
-                if len(t) < 4:
+                # Cheap checks first: most non-course lines are short or start with a digit
+                if len(t) < 4 or not t[0].isalpha():
                     continue
-                if any(s in t.lower() for s in ["страница", "page", "итмо", "университет", "семестр:"]):
+                if _PDF_SKIP_RE.search(t):
                     continue
                 # likely a course if starts with letter and contains lowercase Cyrillic/Latin
-                if (t[0].isalpha()) and any(ch.islower() for ch in t):
+                if any(ch.islower() for ch in t):
                     add_course(t)
         except Exception as e:
             logger.warning("Failed to parse academic_plan PDF: %s", e)
 
     # 3) As last resort, use HTML heuristics
     if not curriculum:
-        headings = soup.find_all(["h2", "h3", "h4"], string=re.compile(r"(Учебн|План|Дисциплин|Модул|Выбор|Курс)", re.IGNORECASE))
+        headings = [h for h in _iter_tags(tree, ["h2", "h3", "h4"]) if _HEADING_RE.search(_node_string(h) or "")]
         seen = set()
         for h in headings:
-            sec = h.find_parent(["section", "div"]) or h
-            for li in sec.find_all("li"):
+            sec = _find_parent(h, ["section", "div"]) or h
+            for li in sec.css("li"):
                 txt = _extract_text(li)
                 if txt and (txt, None) not in seen and len(txt) > 3:
                     seen.add((txt, None))
-                    ctype = "elective" if re.search(r"выбор", txt, re.IGNORECASE) else None
+                    ctype = "elective" if _ELECTIVE_RE.search(txt) else None
                     add_course(txt, ctype=ctype)
-            for row in sec.find_all("tr"):
-                cells = [_extract_text(td) for td in row.find_all(["td", "th"])]
+            for row in sec.css("tr"):
+                cells = [_extract_text(td) for td in _find_all(row, ["td", "th"])]
                 if len(cells) >= 1:
                     name = cells[0]
                     if name and (name, None) not in seen and len(name) > 3:
@@ -175,41 +262,34 @@ def parse_program(url: str) -> Program:
 
     # Contacts: try to find phone/email links
     contacts: Dict[str, str] = {}
-    email_link = soup.find("a", href=re.compile(r"mailto:", re.IGNORECASE))
-    phone_link = soup.find("a", href=re.compile(r"tel:", re.IGNORECASE))
-    if email_link:
+    email_link = _find_link(tree, _EMAIL_RE)
+    phone_link = _find_link(tree, _TEL_RE)
+    if email_link is not None:
         contacts["email"] = _extract_text(email_link)
-    if phone_link:
+    if phone_link is not None:
         contacts["phone"] = _extract_text(phone_link)
 
-    # Heuristics for tuition, duration, language, if missing
-    fulltext = page_text
+    # Heuristics for tuition, duration, language, if missing.
+    # The whole-page text walks the entire DOM, so it is built only when a fallback needs it.
+    page_text: Optional[str] = None
+
+    def fulltext() -> str:
+        nonlocal page_text
+        if page_text is None:
+            page_text = _extract_text(tree.root)
+        return page_text
 
     if not tuition:
-        tuition_patterns = [
-            re.compile(r"(?:стоимост[ьи]|цена)[^\n\r\.:]{0,60}?([\d\s]{3,}(?:[.,]\d{3})?\s*(?:₽|руб\.?|рублей|RUB))", re.IGNORECASE),
-            re.compile(r"([\d\s]{3,}(?:[.,]\d{3})?\s*(?:₽|руб\.?|рублей|RUB))\s*(?:в год|за год|/год)", re.IGNORECASE),
-        ]
-        tuition = _first_match(tuition_patterns, fulltext)
+        tuition = _first_match(_TUITION_PATTERNS, fulltext())
 
     if not duration:
-        duration_patterns = [
-            re.compile(r"(?:срок\s*обучения|продолжительность)[^\n\r\.:]{0,40}?(\d+(?:[.,]\d+)?\s*г(?:ода|одов|\.)?)", re.IGNORECASE),
-            re.compile(r"(\d+(?:[.,]\d+)?\s*г(?:ода|одов|\.)?)\s*(?:обучения)?", re.IGNORECASE),
-        ]
-        duration = _first_match(duration_patterns, fulltext)
+        duration = _first_match(_DURATION_PATTERNS, fulltext())
 
     if not language:
-        lang_patterns = [
-            re.compile(r"(?:язык\s*обучения|language)[^\n\r\.:]{0,40}?(русский|английский|русский и английский|bilingual|english|russian)", re.IGNORECASE),
-        ]
-        language = _first_match(lang_patterns, fulltext)
+        language = _first_match(_LANG_PATTERNS, fulltext())
 
     if not faculty:
-        fac_patterns = [
-            re.compile(r"(?:факультет|меганаправление|школа)[^\n\r\.:]{0,60}?([A-Za-zА-Яа-я \-«»\"]{6,60})", re.IGNORECASE),
-        ]
-        fac = _first_match(fac_patterns, fulltext)
+        fac = _first_match(_FAC_PATTERNS, fulltext())
         faculty = fac or faculty
 
     program = Program(
@@ -229,23 +309,37 @@ def parse_program(url: str) -> Program:
     return program
 
 
+# Pages are I/O bound; per-host politeness is enforced by fetch_html's throttle
+_MAX_WORKERS = 8
+
+
+def _parse_item(url: str) -> Optional[Dict[str, Any]]:
+    try:
+        p = parse_program(url)
+        item = asdict(p)
+        # Convert dataclasses in curriculum
+        item["curriculum"] = [asdict(c) for c in p.curriculum]
+        return item
+    except Exception as e:
+        logger.exception("Failed to parse %s: %s", url, e)
+        return None
+
+
 def main() -> None:
     setup_logging()
     parser = argparse.ArgumentParser(description="Parse ITMO program pages")
     parser.add_argument("--urls", nargs="+", required=True, help="Program URLs")
     parser.add_argument("--out", required=True, help="Output JSON path")
+    parser.add_argument("--http-cache", action="store_true", help="Cache HTTP responses on disk for a day (requests-cache)")
     args = parser.parse_args()
-
-    programs: List[Dict[str, Any]] = []
-    for url in args.urls:
-        try:
-            p = parse_program(url)
-            item = asdict(p)
-            # Convert dataclasses in curriculum
-            item["curriculum"] = [asdict(c) for c in p.curriculum]
-            programs.append(item)
-        except Exception as e:
-            logger.exception("Failed to parse %s: %s", url, e)
+    if args.http_cache:
+        enable_http_cache()
+
+    # Fetch every host's robots.txt concurrently before the page workers start
+    robots_cache.prewarm(args.urls)
+    # map() keeps the input order of the URLs
+    with ThreadPoolExecutor(max_workers=min(_MAX_WORKERS, len(args.urls))) as ex:
+        programs: List[Dict[str, Any]] = [item for item in ex.map(_parse_item, args.urls) if item is not None]
 
     write_json(programs, args.out)
     logger.info("Saved %d programs to %s", len(programs), args.out)
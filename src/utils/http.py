@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Connections are kept alive and reused for every request to the same host
+_POOL_SIZE = 16
+
+_session: requests.Session = requests.Session()
+
+
+def _mount_pool(session: requests.Session) -> requests.Session:
+    adapter = HTTPAdapter(pool_connections=_POOL_SIZE, pool_maxsize=_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_mount_pool(_session)
+
+
+def get_session() -> requests.Session:
+    return _session
+
+
+def enable_http_cache(cache_name: str = ".cache/http", expire_after: int = 86400) -> None:
+    """Replace the shared session with an on-disk caching one, so reruns skip the network."""
+    global _session
+    try:
+        import requests_cache
+    except ImportError:
+        logger.warning("requests-cache is not installed; HTTP responses will not be cached")
+        return
+    _session = _mount_pool(requests_cache.CachedSession(cache_name, expire_after=expire_after))
+    logger.info("HTTP cache enabled at %s (expires after %ds)", cache_name, expire_after)
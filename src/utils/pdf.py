@@ -1,21 +1,43 @@
 from __future__ import annotations
 
-import io
 import logging
-from typing import Optional
+import tempfile
 
-import requests
-from pdfminer.high_level import extract_text as pdf_extract_text
+import pypdfium2 as pdfium
+
+from src.utils.http import get_session
 
 logger = logging.getLogger(__name__)
 
+# Downloads larger than this spill from memory to a temporary file
+_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+_CHUNK_BYTES = 64 * 1024
+
+
+def _pdf_text(src) -> str:
+    # PDFium (C++) extracts text an order of magnitude faster than pure-Python pdfminer
+    pdf = pdfium.PdfDocument(src)
+    try:
+        pages = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            pages.append(textpage.get_text_bounded())
+            textpage.close()
+            page.close()
+        return "\n".join(pages)
+    finally:
+        pdf.close()
+
 
 def extract_text_from_pdf(url_or_path: str, timeout_sec: int = 30) -> str:
     if url_or_path.startswith("http://") or url_or_path.startswith("https://"):
-        resp = requests.get(url_or_path, timeout=timeout_sec)
-        resp.raise_for_status()
-        bio = io.BytesIO(resp.content)
-        text = pdf_extract_text(bio) or ""
-        return text
+        # PDFium needs random access, so the body is streamed into a seekable spool instead of resp.content
+        with get_session().get(url_or_path, timeout=timeout_sec, stream=True) as resp, \
+                tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_BYTES) as buf:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(_CHUNK_BYTES):
+                buf.write(chunk)
+            buf.seek(0)
+            return _pdf_text(buf) or ""
     else:
-        return pdf_extract_text(url_or_path) or "" 
\ No newline at end of file
+        return _pdf_text(url_or_path) or ""
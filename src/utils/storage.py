@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-import json
 from pathlib import Path
-from typing import Any, Dict, Iterable
+from typing import Any, Dict, Iterable, Iterator
+
+import orjson
 
 
 def ensure_dir(path: str | Path) -> None:
@@ -13,27 +14,36 @@ def ensure_dir(path: str | Path) -> None:
 def write_json(obj: Any, path: str | Path) -> None:
     p = Path(path)
     ensure_dir(p.parent)
-    with p.open("w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+    # orjson always emits UTF-8, matching the previous ensure_ascii=False output
+    p.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
 
 
 def read_json(path: str | Path) -> Any:
-    with Path(path).open("r", encoding="utf-8") as f:
-        return json.load(f)
+    return orjson.loads(Path(path).read_bytes())
 
 
 def write_jsonl(records: Iterable[Dict[str, Any]], path: str | Path) -> None:
     p = Path(path)
     ensure_dir(p.parent)
-    with p.open("w", encoding="utf-8") as f:
+    with p.open("wb") as f:
         for r in records:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            f.write(orjson.dumps(r))
+            f.write(b"\n")
 
 
 def read_jsonl(path: str | Path) -> list[dict[str, Any]]:
-    items: list[dict[str, Any]] = []
-    with Path(path).open("r", encoding="utf-8") as f:
+    return list(iread_jsonl(path))
+
+
+def iread_jsonl(path: str | Path) -> Iterator[dict[str, Any]]:
+    # Streaming variant of read_jsonl: one record in memory at a time
+    with Path(path).open("rb") as f:
         for line in f:
             if line.strip():
-                items.append(json.loads(line))
-    return items 
\ No newline at end of file
+                yield orjson.loads(line)
+
+
+def count_jsonl(path: str | Path) -> int:
+    # Same record boundaries as iread_jsonl, without parsing
+    with Path(path).open("rb") as f:
+        return sum(1 for line in f if line.strip())
@@ -1,29 +1,38 @@
 from __future__ import annotations
 
 import re
+from bisect import bisect_right
+from itertools import accumulate
 from typing import Iterable, List
 
 
+def compile_keywords(words: Iterable[str]) -> re.Pattern[str]:
+    """Build one case-insensitive alternation that finds any of the given substrings in a single scan."""
+    return re.compile("|".join(re.escape(w) for w in words), re.IGNORECASE)
+
+
+# Sentence-ish boundaries used by split_to_chunks
+_SENT_RE = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
 def normalize_whitespace(text: str) -> str:
-    return re.sub(r"\s+", " ", text).strip()
+    # str.split() collapses the same Unicode whitespace as \s, in C and without a regex
+    return " ".join(text.split())
 
 
 def split_to_chunks(text: str, max_len: int = 700) -> List[str]:
     # Simple sentence-ish split, then re-pack to chunks
-    parts = re.split(r"(?<=[.!?…])\s+|\n+", text)
+    parts = _SENT_RE.split(text)
     parts = [p.strip() for p in parts if p and p.strip()]
+    # Greedy packing over prefix sums of the part lengths (+1 for the joining space): each chunk takes
+    # the longest run that fits in max_len, found by binary search, and at least one part.
+    ends = [0, *accumulate(len(p) + 1 for p in parts)]
     chunks: List[str] = []
-    buf: List[str] = []
-    total = 0
-    for p in parts:
-        if total + len(p) + 1 > max_len:
-            if buf:
-                chunks.append(" ".join(buf).strip())
-                buf, total = [], 0
-        buf.append(p)
-        total += len(p) + 1
-    if buf:
-        chunks.append(" ".join(buf).strip())
+    i = 0
+    while i < len(parts):
+        j = max(bisect_right(ends, ends[i] + max_len) - 1, i + 1)
+        chunks.append(" ".join(parts[i:j]))
+        i = j
     return chunks
 
 